@@ -1,11 +1,15 @@
 # /api/index.py
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, render_template, request, jsonify, redirect, url_for, make_response
 import os
-from supabase import create_client, Client
+import re
 from urllib.parse import quote
+import gzip
 import traceback
 import sys
+import threading
+from collections import defaultdict
+from typing import NamedTuple
 
 # --- App Initialization ---
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
@@ -25,7 +29,20 @@ def initialize_supabase():
         return None
     
     try:
-        client = create_client(SUPABASE_URL, SUPABASE_KEY)
+        # Imported here so page-serving cold starts don't pay for supabase/httpx.
+        import httpx
+        from supabase import create_client, ClientOptions
+
+        # One pooled keep-alive client shared by every request on a warm instance,
+        # so repeat RPC/upsert calls skip the TCP+TLS handshake. The transport retries
+        # failed connection attempts only, so a POST is never sent twice.
+        transport = httpx.HTTPTransport(
+            http2=True,
+            retries=3,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=30.0)
+        )
+        http_client = httpx.Client(transport=transport, timeout=120, follow_redirects=True)
+        client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=http_client))
         print("--- Supabase client initialized successfully ---", file=sys.stderr)
         return client
     except Exception as e:
@@ -33,7 +50,22 @@ def initialize_supabase():
         traceback.print_exc(file=sys.stderr)
         return None
 
-supabase = initialize_supabase()
+supabase = None
+evaluations_table = None
+_supabase_attempted = False
+_supabase_lock = threading.Lock()
+
+def get_supabase():
+    """Return the shared Supabase client, creating it on first use"""
+    global supabase, evaluations_table, _supabase_attempted
+    if not _supabase_attempted:
+        with _supabase_lock:
+            if not _supabase_attempted:
+                supabase = initialize_supabase()
+                # Request builders are stateless, so one per table is reused across requests.
+                evaluations_table = supabase.table('evaluations') if supabase else None
+                _supabase_attempted = True
+    return supabase
 
 # --- Image Data Loading ---
 STATIC_IMAGE_FOLDER = 'static/evaluation_images'
@@ -41,7 +73,26 @@ CLASS_ABBREVIATIONS = {
     'Copra Cake': 'CC', 'Cracked Corn': 'CORN', 'Feed Wheats': 'FW',
     'Hard Pollard': 'HP', 'Jocky Oats': 'JO', 'Rice Bran': 'RB', 'US Soya': 'SOY'
 }
-EVALUATION_ITEMS = []
+# Same abbreviations keyed by the class as written in filenames ('Copra_Cake').
+CLASS_ABBREVIATIONS_BY_FILE = {name.replace(' ', '_'): abbr for name, abbr in CLASS_ABBREVIATIONS.items()}
+
+class Item(NamedTuple):
+    """One evaluation image; immutable and far smaller than the equivalent dict"""
+    metric: str
+    class_: str
+    case: str
+    web_path: str
+    eval_id: str
+    id: int
+
+# <Class_Name>__<metric>__<case>.png; each part is words joined by single underscores, so
+# names with extra '__' separators are skipped like the old three-way split('__') did.
+FILENAME_PART = r'[^_]+(?:_[^_]+)*'
+FILENAME_PATTERN = re.compile(
+    rf'^(?P<cls>{FILENAME_PART})__(?P<metric>{FILENAME_PART})__(?P<case>{FILENAME_PART})\.png$', re.IGNORECASE
+)
+# Names made only of these characters are unchanged by quote(), so the call can be skipped.
+IS_URL_SAFE_FILENAME = re.compile(r'[A-Za-z0-9._-]+').fullmatch
 
 def load_evaluation_items():
     print("--- Loading evaluation items... ---", file=sys.stderr)
@@ -52,60 +103,117 @@ def load_evaluation_items():
     project_root = os.path.dirname(os.path.dirname(__file__))
     image_folder_path = os.path.join(project_root, STATIC_IMAGE_FOLDER)
     
+    url_prefix = f"https://raw.githubusercontent.com/{GITHUB_USERNAME}/{IMAGE_REPO_NAME}/refs/heads/{BRANCH_NAME}/{STATIC_IMAGE_FOLDER}/"
+    abbr_get = CLASS_ABBREVIATIONS_BY_FILE.get
+    parse_filename = FILENAME_PATTERN.match
+    is_url_safe = IS_URL_SAFE_FILENAME
+    intern = sys.intern
+    class_info = {}  # class_part -> (display name, abbreviation), shared by every item of the class
+
     image_data = []
     if os.path.isdir(image_folder_path):
-        for filename in sorted(os.listdir(image_folder_path)):
-            if filename.lower().endswith(".png"):
-                try:
-                    base_name, _ = os.path.splitext(filename)
-                    class_part, metric_part, case_part = base_name.split('__')
-                    class_name = class_part.replace('_', ' ')
-                    safe_filename = quote(filename)
-                    public_url = f"https://raw.githubusercontent.com/{GITHUB_USERNAME}/{IMAGE_REPO_NAME}/refs/heads/{BRANCH_NAME}/{STATIC_IMAGE_FOLDER}/{safe_filename}"
-                    image_data.append({"metric": metric_part, "class": class_name, "case": case_part, "web_path": public_url})
-                except Exception as e:
-                    print(f"Warning: Could not parse filename '{filename}'. Skipping. Error: {e}", file=sys.stderr)
+        with os.scandir(image_folder_path) as it:
+            filenames = [e.name for e in it if e.is_file(follow_symlinks=False) and e.name.lower().endswith(".png")]
+        filenames.sort()
+        for filename in filenames:
+            m = parse_filename(filename)
+            if not m:
+                print(f"Warning: Could not parse filename '{filename}'. Skipping.", file=sys.stderr)
+                continue
+            class_part = m['cls']
+            info = class_info.get(class_part)
+            if info is None:
+                info = class_info[class_part] = (class_part.replace('_', ' '), abbr_get(class_part, 'UNK'))
+            class_name, class_abbr = info
+            metric_part = intern(m['metric'])
+            case_part = intern(m['case'])
+            image_data.append(Item(
+                metric=metric_part, class_=class_name, case=case_part,
+                web_path=url_prefix + (filename if is_url_safe(filename) else quote(filename)),
+                eval_id=f"{class_abbr}-{metric_part.upper()}-{case_part}",
+                id=len(image_data)
+            ))
     else:
         print(f"CRITICAL WARNING: Local image directory not found at '{image_folder_path}'.", file=sys.stderr)
 
-    for i, item in enumerate(image_data):
-        class_abbr = CLASS_ABBREVIATIONS.get(item['class'], 'UNK')
-        item['eval_id'] = f"{class_abbr}-{item['metric'].upper()}-{item['case']}"
-        item['id'] = i
     print(f" -> Successfully built {len(image_data)} image URLs.", file=sys.stderr)
-    return image_data
+    return tuple(image_data)
 
+# Scanning and parsing the folder takes well under a millisecond, less than compiling a
+# generated item module on Vercel's read-only code directory (no cached .pyc).
 EVALUATION_ITEMS = load_evaluation_items()
 TOTAL_ITEMS = len(EVALUATION_ITEMS)
 
+def prerender_evaluation_pages():
+    """Render every evaluation page once; each page depends only on its item_id"""
+    with app.app_context():
+        return [
+            render_template('index.html', item=item, item_id=i, total_items=TOTAL_ITEMS,
+                            previous_id=i - 1 if i > 0 else None,
+                            next_id=i + 1 if i < TOTAL_ITEMS - 1 else None)
+            for i, item in enumerate(EVALUATION_ITEMS)
+        ]
+
+PRERENDERED_PAGES = prerender_evaluation_pages()
+# Each page is gzipped on its first compressed request and kept, so cold starts don't
+# pay for compressing pages this instance never serves.
+PRERENDERED_PAGES_GZ = [None] * TOTAL_ITEMS
+
+# complete.html takes no context, so it is rendered once as well.
+with app.app_context():
+    COMPLETE_PAGE = render_template('complete.html')
+
 
 # --- ROUTE DEFINITIONS ---
 
+# Static responses are built once and returned as-is on every hit.
+HOME_REDIRECT = redirect('/evaluate/0')
+
 @app.route('/')
 def home():
-    return redirect(url_for('evaluate_item', item_id=0))
+    return HOME_REDIRECT
 
 @app.route('/evaluate/<int:item_id>')
 def evaluate_item(item_id):
     if not 0 <= item_id < TOTAL_ITEMS:
         return redirect(url_for('home'))
-    item = EVALUATION_ITEMS[item_id]
-    previous_id = item_id - 1 if item_id > 0 else None
-    next_id = item_id + 1 if item_id < TOTAL_ITEMS - 1 else None
-    return render_template('index.html', item=item, item_id=item_id, total_items=TOTAL_ITEMS, previous_id=previous_id, next_id=next_id)
+    if request.accept_encodings.quality('gzip') > 0:
+        body = PRERENDERED_PAGES_GZ[item_id]
+        if body is None:
+            body = PRERENDERED_PAGES_GZ[item_id] = gzip.compress(PRERENDERED_PAGES[item_id].encode('utf-8'), compresslevel=6)
+        response = make_response(body)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = make_response(PRERENDERED_PAGES[item_id])
+    response.mimetype = 'text/html'
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 @app.route('/complete')
 def complete():
-    return render_template('complete.html')
+    response = make_response(COMPLETE_PAGE)
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+# The whole catalog for client-side navigation; built once like the pages.
+with app.app_context():
+    ITEMS_RESPONSE = jsonify([item._asdict() for item in EVALUATION_ITEMS])
+ITEMS_RESPONSE.headers['Cache-Control'] = 'public, max-age=3600'
+
+@app.route('/api/items')
+def list_items():
+    return ITEMS_RESPONSE
 
 @app.route('/api/get_new_user_id', methods=['GET'])
 def get_new_user_id():
-    if not supabase:
+    client = get_supabase()
+    if not client:
         error_msg = 'Supabase client not initialized. Check environment variables.'
         print(f"ERROR in get_new_user_id: {error_msg}", file=sys.stderr)
         return jsonify({'error': error_msg}), 500
     try:
-        response = supabase.rpc('get_next_user_id', {}).execute()
+        response = client.rpc('get_next_user_id', {}).execute()
         if response.data:
             return jsonify({'user_id': response.data})
         else:
@@ -115,52 +223,157 @@ def get_new_user_id():
         traceback.print_exc(file=sys.stderr)
         return jsonify({'error': f'Could not generate user ID: {str(e)}'}), 500
 
+# --- Submission Batching ---
+# Rows are buffered per session and upserted together once SUBMIT_BATCH_SIZE is reached
+# or the evaluator saves the last item. Instances are not shared on Vercel, so the
+# default of 1 keeps every "Save & Next" durable; raise it only for long-lived servers.
+SUBMIT_BATCH_SIZE = max(1, int(os.environ.get("SUBMIT_BATCH_SIZE", "1")))
+_pending_submissions = defaultdict(dict)  # session_identifier -> {eval_id: row}
+_pending_lock = threading.Lock()
+
+def queue_submission(row, flush):
+    """Buffer a row and return the batch to upsert, or None if it can wait"""
+    session_id = row['session_identifier']
+    with _pending_lock:
+        pending = _pending_submissions[session_id]
+        # Re-submitting an item replaces its buffered row; an upsert cannot touch the same row twice.
+        pending[row['eval_id']] = row
+        if not flush and len(pending) < SUBMIT_BATCH_SIZE:
+            return None
+        return list(_pending_submissions.pop(session_id).values())
+
+def requeue_submissions(rows):
+    """Put rows from a failed upsert back without overwriting newer submissions"""
+    with _pending_lock:
+        for row in rows:
+            _pending_submissions[row['session_identifier']].setdefault(row['eval_id'], row)
+
+def upsert_evaluations(rows):
+    """Upsert a batch of evaluation rows, putting them back in the buffer if it fails"""
+    # --- THIS IS THE KEY CHANGE ---
+    # Use .upsert() instead of .insert().
+    # 'on_conflict' tells Supabase which columns form the unique key.
+    # If a row with this combination exists, it will be updated.
+    # If not, a new row will be inserted.
+    # returning='minimal' (Prefer: return=minimal) skips echoing the rows back; only success matters.
+    print(f"Attempting to upsert {len(rows)} row(s): {rows}", file=sys.stderr)
+    try:
+        response = evaluations_table.upsert(
+            rows,
+            on_conflict='session_identifier, eval_id',
+            returning='minimal'
+        ).execute()
+
+        # Check for errors from the upsert operation.
+        if hasattr(response, 'error') and response.error:
+            raise Exception(f"Supabase upsert failed: {response.error.message}")
+    except Exception:
+        requeue_submissions(rows)
+        raise
+    print(f"Successfully upserted {len(rows)} row(s) into Supabase.", file=sys.stderr)
+
+def flush_pending_submissions():
+    """Upsert every buffered row, including sessions that stopped mid-batch"""
+    with _pending_lock:
+        rows = [row for pending in _pending_submissions.values() for row in pending.values()]
+        _pending_submissions.clear()
+    if not rows:
+        return
+    try:
+        upsert_evaluations(rows)
+    except Exception as e:
+        print(f"Error flushing buffered submissions (will retry): {e}", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+
+def flush_pending_submissions_forever():
+    while True:
+        _flush_requested.wait(SUBMIT_FLUSH_INTERVAL)
+        _flush_requested.clear()
+        flush_pending_submissions()
+
+# With batching on, a background flush keeps abandoned partial batches from waiting forever.
+# With write-behind on, submit() only buffers and this writer does every upsert, so the
+# response doesn't wait on Supabase. Off by default: a frozen serverless instance never flushes.
+SUBMIT_FLUSH_INTERVAL = float(os.environ.get("SUBMIT_FLUSH_INTERVAL", "5"))
+SUBMIT_WRITE_BEHIND = os.environ.get("SUBMIT_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+_flush_requested = threading.Event()
+if SUBMIT_BATCH_SIZE > 1 or SUBMIT_WRITE_BEHIND:
+    threading.Thread(target=flush_pending_submissions_forever, daemon=True).start()
+
+# Longer values can't be an id or rating, and int() raises past 4300 digits on 3.11+.
+MAX_INT_LENGTH = 18
+
+def _to_int(value, default=None):
+    """Parse a plain decimal integer without raising; malformed input gives default"""
+    if value and len(value) <= MAX_INT_LENGTH:
+        digits = value[1:] if value[0] == '-' else value
+        if digits.isascii() and digits.isdigit():
+            return int(value)
+    return default
+
+
+# Required form fields and their column types, read in one pass by submit().
+SUBMIT_FIELDS = (
+    ('session_identifier', _to_int), ('eval_id', str), ('item_class', str),
+    ('item_metric', str), ('item_case', str), ('comparative_rating', str),
+    ('test_rating', _to_int), ('comparison_rating', _to_int)
+)
+SUBMIT_INT_FIELDS = tuple(name for name, cast in SUBMIT_FIELDS if cast is _to_int)
+
+def reject_submission(error_msg):
+    """Log and return a 400 for a submission that cannot be saved as sent"""
+    print(f"ERROR in submit: {error_msg}", file=sys.stderr)
+    return jsonify({'error': error_msg}), 400
+
 # --- MODIFIED SUBMIT FUNCTION ---
 @app.route('/api/submit', methods=['POST'])
 def submit():
-    if not supabase:
+    client = get_supabase()
+    if not client:
         error_msg = "Supabase client not initialized. Please check your environment variables in Vercel."
         print(f"ERROR in submit: {error_msg}", file=sys.stderr)
         return jsonify({'error': error_msg}), 500
     
     try:
-        form_data = request.form.to_dict()
-        print(f"Received form data: {form_data}", file=sys.stderr)
+        form = request.form
+        print(f"Received form data: {form}", file=sys.stderr)
         
+        missing = [name for name, _ in SUBMIT_FIELDS if name not in form]
+        if missing:
+            return reject_submission(f"Missing required field(s): {', '.join(missing)}")
+
         # Prepare the data dictionary for the upsert operation.
-        data_to_upsert = {
-            'session_identifier': int(form_data.get('session_identifier')),
-            'eval_id': form_data.get('eval_id'), 
-            'item_class': form_data.get('item_class'),
-            'item_metric': form_data.get('item_metric'), 
-            'item_case': form_data.get('item_case'),
-            'comparative_rating': form_data.get('comparative_rating'),
-            'test_rating': int(form_data.get('test_rating')),
-            'comparison_rating': int(form_data.get('comparison_rating')),
-            'comments': form_data.get('comments', '').strip()
-        }
+        data_to_upsert = {name: cast(form[name]) for name, cast in SUBMIT_FIELDS}
+        invalid = [name for name in SUBMIT_INT_FIELDS if data_to_upsert[name] is None]
+        if invalid:
+            return reject_submission(f"Invalid integer value for: {', '.join(invalid)}")
+        data_to_upsert['comments'] = form.get('comments', '').strip()
         
-        # --- THIS IS THE KEY CHANGE ---
-        # Use .upsert() instead of .insert().
-        # 'on_conflict' tells Supabase which columns form the unique key.
-        # If a row with this combination exists, it will be updated.
-        # If not, a new row will be inserted.
-        print(f"Attempting to upsert: {data_to_upsert}", file=sys.stderr)
-        response = supabase.table('evaluations').upsert(
-            data_to_upsert,
-            on_conflict='session_identifier, eval_id'
-        ).execute()
-        
-        # Check for errors from the upsert operation.
-        if hasattr(response, 'error') and response.error:
-            raise Exception(f"Supabase upsert failed: {response.error.message}")
-        
-        print("Successfully upserted a row into Supabase.", file=sys.stderr)
+        # Only an absent next_item_id or 'None' marks the last item; anything else must be a valid id.
+        next_id_str = form.get('next_item_id')
+        is_last_item = next_id_str in (None, 'None')
+        next_id = None if is_last_item else _to_int(next_id_str, default=-1)
+        if next_id is not None and not 0 <= next_id < TOTAL_ITEMS:
+            return reject_submission("Invalid value for: next_item_id")
+        batch = queue_submission(data_to_upsert, flush=is_last_item)
+
+        if batch and SUBMIT_WRITE_BEHIND:
+            # Hand the ready batch to the background writer instead of waiting on it.
+            requeue_submissions(batch)
+            _flush_requested.set()
+        elif batch:
+            upsert_evaluations(batch)
+        else:
+            print(f"Buffered submission for {data_to_upsert['eval_id']}.", file=sys.stderr)
         
-        # Redirection logic remains the same.
-        next_id_str = form_data.get('next_item_id')
-        if next_id_str and next_id_str != 'None':
-            return redirect(url_for('evaluate_item', item_id=int(next_id_str)))
+        # The page script saves via fetch() and swaps in the next item itself;
+        # a plain form post (no JavaScript) still gets the redirect.
+        if request.accept_mimetypes.best == 'application/json':
+            next_item = None if is_last_item else EVALUATION_ITEMS[next_id]._asdict()
+            return jsonify({'ok': True, 'next_id': next_id, 'next_item': next_item})
+
+        if not is_last_item:
+            return redirect(url_for('evaluate_item', item_id=next_id))
         else:
             return redirect(url_for('complete'))
             
@@ -172,12 +385,24 @@ def submit():
 
 
 # Health check endpoint for debugging
+# The client is created lazily on the first database request, so a fresh instance reports
+# 'not_attempted' rather than a failure. One response is cached per state.
+HEALTH_RESPONSES = {}
+
 @app.route('/api/health')
 def health():
-    return jsonify({
-        'status': 'ok',
-        'supabase_initialized': supabase is not None,
-        'has_supabase_url': bool(os.environ.get("SUPABASE_URL")),
-        'has_supabase_key': bool(os.environ.get("SUPABASE_SERVICE_ROLE_KEY")),
-        'total_items': TOTAL_ITEMS
-    })
\ No newline at end of file
+    if not _supabase_attempted:
+        supabase_status = 'not_attempted'
+    else:
+        supabase_status = 'initialized' if supabase is not None else 'failed'
+    response = HEALTH_RESPONSES.get(supabase_status)
+    if response is None:
+        response = HEALTH_RESPONSES[supabase_status] = jsonify({
+            'status': 'ok',
+            'supabase_initialized': supabase_status == 'initialized',
+            'supabase_status': supabase_status,
+            'has_supabase_url': bool(os.environ.get("SUPABASE_URL")),
+            'has_supabase_key': bool(os.environ.get("SUPABASE_SERVICE_ROLE_KEY")),
+            'total_items': TOTAL_ITEMS
+        })
+    return response
\ No newline at end of file